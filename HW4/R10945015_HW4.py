@@ -29,17 +29,20 @@ import numpy as np
 import torch
 import random
 
-def set_seed(seed):
+def set_seed(seed, deterministic=False):
     np.random.seed(seed)
     random.seed(seed)
     torch.manual_seed(seed)
     if torch.cuda.is_available():
         torch.cuda.manual_seed(seed)
         torch.cuda.manual_seed_all(seed)
+    # cudnn.benchmark is turned on in the training main only, where input shapes are fixed.
     torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.deterministic = deterministic
 
-set_seed(777)
+set_seed(777, deterministic=False)
+# Allow TF32 matmuls on Ampere+ GPUs.
+torch.set_float32_matmul_precision('high')
 
 
 # # Data
@@ -69,17 +72,50 @@ set_seed(777)
 # 
 # 
 # For efficiency, we segment the mel-spectrograms into segments in the traing step.
+# The first time the dataset is built, every uttr-*.pt is packed into `feats.bin` (fp16 memmap) in the data directory,
+# so training never unpickles per sample. The speaker ids and the (offset, mel_len) index into `feats.bin` are cached
+# together in `meta_cache.pkl`, which is written last; delete it if the dataset changes and both caches are rebuilt.
 
 # In[2]:
 
 
 import os
 import json
+import pickle
 import torch
 import random
+import numpy as np
 from pathlib import Path
 from torch.utils.data import Dataset
-from torch.nn.utils.rnn import pad_sequence
+
+
+def build_feature_cache(data_dir, metadata, feats_name="feats.bin"):
+    """Pack every uttr-*.pt into one fp16 memmap and return its (offset, mel_len) index."""
+    n_mels = metadata["n_mels"]
+    speakers = metadata["speakers"]
+
+    # Rows of the index follow the iteration order of metadata["speakers"].
+    index = []
+    total_frames = 0
+    for speaker in speakers.keys():
+        for utterances in speakers[speaker]:
+            index.append([total_frames, utterances["mel_len"]])
+            total_frames += utterances["mel_len"]
+    index = np.array(index, dtype=np.int64)
+
+    feats = np.memmap(
+        os.path.join(data_dir, feats_name), dtype=np.float16, mode="w+", shape=(total_frames, n_mels)
+    )
+    i = 0
+    for speaker in speakers.keys():
+        for utterances in speakers[speaker]:
+            mel = torch.load(os.path.join(data_dir, utterances["feature_path"]))
+            offset, mel_len = index[i]
+            feats[offset:offset+mel_len] = mel.numpy().astype(np.float16)
+            i += 1
+    feats.flush()
+    del feats
+    return index
 
 
 class myDataset(Dataset):
@@ -87,40 +123,63 @@ class myDataset(Dataset):
         self.data_dir = data_dir
         self.segment_len = segment_len
 
-        # Load the mapping from speaker neme to their corresponding id. 
-        mapping_path = Path(data_dir) / "mapping.json"
-        mapping = json.load(mapping_path.open())
-        self.speaker2id = mapping["speaker2id"]
-
-        # Load metadata of training data.
-        metadata_path = Path(data_dir) / "metadata.json"
-        metadata = json.load(open(metadata_path))["speakers"]
-
-        # Get the total number of speaker.
-        self.speaker_num = len(metadata.keys())
-        self.data = []
-        for speaker in metadata.keys():
-            for utterances in metadata[speaker]:
-                self.data.append([utterances["feature_path"], self.speaker2id[speaker]])
+        data_path = Path(data_dir)
+        cache_path = data_path / "meta_cache.pkl"
+        self.feats_path = os.path.join(data_dir, "feats.bin")
+        if cache_path.exists() and os.path.exists(self.feats_path):
+            # Reuse the parsed metadata instead of reading the json files again.
+            with cache_path.open("rb") as f:
+                self.speaker2id, self.speaker_num, self.n_mels, self.speaker_ids, self.index = pickle.load(f)
+        else:
+            # Load the mapping from speaker neme to their corresponding id. 
+            with (data_path / "mapping.json").open() as f:
+                self.speaker2id = json.load(f)["speaker2id"]
+
+            # Load metadata of training data.
+            with (data_path / "metadata.json").open() as f:
+                metadata = json.load(f)
+            self.n_mels = metadata["n_mels"]
+            speakers = metadata["speakers"]
+
+            # Get the total number of speaker.
+            self.speaker_num = len(speakers)
+            # Row i is the speaker id of the utterance at row i of self.index.
+            self.speaker_ids = np.array(
+                [self.speaker2id[speaker] for speaker, utterances in speakers.items() for _ in utterances],
+                dtype=np.int32,
+            )
+            # Pack all mel-spectrograms into one memmap; both caches come from the same metadata.
+            self.index = build_feature_cache(data_dir, metadata)
+
+            # Written last, and via a temp file, so it only exists once feats.bin is complete.
+            tmp_path = cache_path.with_suffix(".pkl.tmp")
+            with tmp_path.open("wb") as f:
+                pickle.dump((self.speaker2id, self.speaker_num, self.n_mels, self.speaker_ids, self.index), f)
+            os.replace(tmp_path, cache_path)
+        assert len(self.speaker_ids) == len(self.index), "meta_cache.pkl is inconsistent; delete it to rebuild."
+        # Opened lazily so every DataLoader worker maps the file itself.
+        self.feats = None
  
     def __len__(self):
-        return len(self.data)
+        return len(self.speaker_ids)
  
     def __getitem__(self, index):
-        feat_path, speaker = self.data[index]
-        # Load preprocessed mel-spectrogram.
-        mel = torch.load(os.path.join(self.data_dir, feat_path))
+        if self.feats is None:
+            self.feats = np.memmap(self.feats_path, dtype=np.float16, mode="r").reshape(-1, self.n_mels)
+        speaker = self.speaker_ids[index]
+        offset, mel_len = self.index[index]
 
         # Segmemt mel-spectrogram into "segment_len" frames.
-        if len(mel) > self.segment_len:
+        if mel_len > self.segment_len:
             # Randomly get the starting point of the segment.
-            start = random.randint(0, len(mel) - self.segment_len)
+            start = random.randint(0, mel_len - self.segment_len)
             # Get a segment with "segment_len" frames.
-            mel = torch.FloatTensor(mel[start:start+self.segment_len])
+            mel = self.feats[offset+start:offset+start+self.segment_len]
         else:
-            mel = torch.FloatTensor(mel)
+            mel = self.feats[offset:offset+mel_len]
+        mel = torch.from_numpy(mel.astype(np.float32))
         # Turn the speaker id into long for computing loss later.
-        speaker = torch.FloatTensor([speaker]).long()
+        speaker = torch.tensor(speaker, dtype=torch.long)
         return mel, speaker
  
     def get_speaker_number(self):
@@ -135,8 +194,24 @@ class myDataset(Dataset):
 
 
 import torch
-from torch.utils.data import DataLoader, random_split
-from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader, Sampler, random_split
+
+
+class InfiniteSampler(Sampler):
+    """Yield reshuffled indices forever so the train loader never has to be restarted."""
+    def __init__(self, dataset, rank=0, world_size=1):
+        self.dataset = dataset
+        self.rank = rank
+        self.world_size = world_size
+        # Every process draws the same permutations and keeps its own 1/world_size share.
+        self.seed = torch.initial_seed()
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed)
+        while True:
+            perm = torch.randperm(len(self.dataset), generator=generator)
+            yield from perm[self.rank::self.world_size].tolist()
 
 
 def collate_batch(batch):
@@ -144,12 +219,20 @@ def collate_batch(batch):
     """Collate a batch of data."""
     mel, speaker = zip(*batch)
     # Because we train the model batch by batch, we need to pad the features in the same batch to make their lengths the same.
-    mel = pad_sequence(mel, batch_first=True, padding_value=-20)    # pad log 10^(-20) which is very small value.
+    max_len = max(m.shape[0] for m in mel)
+    if all(m.shape[0] == max_len for m in mel):
+        # Almost every utterance is cut to exactly segment_len frames, so a single stack is enough.
+        mel = torch.stack(mel, 0)
+    else:
+        out = torch.full((len(mel), max_len, mel[0].shape[1]), -20.0)    # pad log 10^(-20) which is very small value.
+        for i, m in enumerate(mel):
+            out[i, :m.shape[0]] = m
+        mel = out
     # mel: (batch size, length, 40)
-    return mel, torch.FloatTensor(speaker).long()
+    return mel, torch.stack(speaker)
 
 
-def get_dataloader(data_dir, batch_size, n_workers):
+def get_dataloader(data_dir, batch_size, n_workers, rank=0, world_size=1):
     """Generate dataloader"""
     dataset = myDataset(data_dir)
     speaker_num = dataset.get_speaker_number()
@@ -157,15 +240,25 @@ def get_dataloader(data_dir, batch_size, n_workers):
     trainlen = int(0.9 * len(dataset))
     lengths = [trainlen, len(dataset) - trainlen]
     trainset, validset = random_split(dataset, lengths)
+    # Keep workers alive across epochs and let each prefetch a few batches ahead.
+    worker_kwargs = dict(
+        persistent_workers=n_workers > 0,
+        prefetch_factor=4 if n_workers > 0 else None,
+    )
+    pin_memory_device = "cuda" if torch.cuda.is_available() else ""
 
     train_loader = DataLoader(
         trainset,
         batch_size=batch_size,
-        shuffle=True,
+        sampler=InfiniteSampler(trainset, rank, world_size),
         drop_last=True,
         num_workers=n_workers,
         pin_memory=True,
+        pin_memory_device=pin_memory_device,
         collate_fn=collate_batch,
+        # Workers are seeded from this generator; offset it by rank so ranks draw different crops.
+        generator=torch.Generator().manual_seed(torch.initial_seed() + rank),
+        **worker_kwargs,
     )
     valid_loader = DataLoader(
         validset,
@@ -173,7 +266,9 @@ def get_dataloader(data_dir, batch_size, n_workers):
         num_workers=n_workers,
         drop_last=True,
         pin_memory=True,
+        pin_memory_device=pin_memory_device,
         collate_fn=collate_batch,
+        **worker_kwargs,
     )
 
     return train_loader, valid_loader, speaker_num
@@ -287,7 +382,29 @@ import math
 
 import torch
 from torch.optim import Optimizer
-from torch.optim.lr_scheduler import LambdaLR
+
+
+class PrecomputedLR:
+    """Scale each param group's initial lr by a precomputed table of multipliers."""
+
+    def __init__(self, optimizer, lr_factors, last_epoch=-1):
+        self.optimizer = optimizer
+        self.lr_factors = lr_factors
+        for group in optimizer.param_groups:
+            group.setdefault("initial_lr", group["lr"])
+        self.base_lrs = [group["initial_lr"] for group in optimizer.param_groups]
+        self.last_epoch = last_epoch
+        self.step()
+
+    def step(self):
+        self.last_epoch += 1
+        # Hold the last value once training runs past the end of the table.
+        factor = self.lr_factors[min(self.last_epoch, len(self.lr_factors) - 1)]
+        for group, base_lr in zip(self.optimizer.param_groups, self.base_lrs):
+            group["lr"] = base_lr * factor
+
+    def get_last_lr(self):
+        return [group["lr"] for group in self.optimizer.param_groups]
 
 
 def get_cosine_schedule_with_warmup(
@@ -316,7 +433,7 @@ def get_cosine_schedule_with_warmup(
         The index of the last epoch when resuming training.
 
     Return:
-        :obj:`torch.optim.lr_scheduler.LambdaLR` with the appropriate schedule.
+        :obj:`PrecomputedLR` with the appropriate schedule.
     """
     def lr_lambda(current_step):
         # Warmup
@@ -330,7 +447,9 @@ def get_cosine_schedule_with_warmup(
             0.0, 0.5 * (1.0 + math.cos(math.pi * float(num_cycles) * 2.0 * progress))
         )
 
-    return LambdaLR(optimizer, lr_lambda, last_epoch)
+    # Evaluate the schedule once up front instead of calling lr_lambda on every step.
+    lr_factors = [lr_lambda(step) for step in range(num_training_steps + 1)]
+    return PrecomputedLR(optimizer, lr_factors, last_epoch)
 
 
 # # Model Function
@@ -340,48 +459,94 @@ def get_cosine_schedule_with_warmup(
 
 
 import torch
+import torch.nn.functional as F
+
+
+@torch.compile
+def loss_and_acc(logits, labels):
+    """Cross entropy and top-1 accuracy from a single read of the logits."""
+    loss = F.nll_loss(logits.log_softmax(-1), labels)
+    # Get the speaker id with highest probability and compute accuracy.
+    accuracy = (logits.argmax(-1) == labels).float().mean()
+    return loss, accuracy
 
 
-def model_fn(batch, model, criterion, device):
+def model_fn(batch, model, device):
     """Forward a batch through the model."""
 
     mels, labels = batch
-    mels = mels.to(device)
-    labels = labels.to(device)
+    mels = mels.to(device, non_blocking=True)
+    labels = labels.to(device, non_blocking=True)
     
-    outs = model(mels).to(device)
-
-    loss = criterion(outs, labels)
+    # Run the forward pass in bf16; no GradScaler is needed since bf16 keeps the fp32 exponent range.
+    with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+        outs = model(mels)
 
-    # Get the speaker id with highest probability.
-    preds = outs.argmax(1)
-    # Compute accuracy.
-    accuracy = torch.mean((preds == labels).float())
+        loss, accuracy = loss_and_acc(outs, labels)
 
     return loss, accuracy
 
 
+def prefetch_to_device(dataloader, device):
+    """Copy the next batch to device on a side stream while the current one is being trained on."""
+    if device.type != "cuda":
+        yield from dataloader
+        return
+
+    stream = torch.cuda.Stream()
+    batches = iter(dataloader)
+
+    def load():
+        mels, labels = next(batches)
+        with torch.cuda.stream(stream):
+            return mels.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+
+    try:
+        next_batch = load()
+    except StopIteration:
+        return
+    while True:
+        # Wait for the copy, and keep the side-stream tensors alive until the default stream is done with them.
+        torch.cuda.current_stream().wait_stream(stream)
+        mels, labels = next_batch
+        mels.record_stream(torch.cuda.current_stream())
+        labels.record_stream(torch.cuda.current_stream())
+        try:
+            next_batch = load()
+        except StopIteration:
+            yield mels, labels
+            return
+        yield mels, labels
+
+
 # # Validate
 # - Calculate accuracy of the validation set.
 
 # In[8]:
 
 
-from tqdm import tqdm
+# Imported under its own name: the inference cell rebinds `tqdm` to tqdm.notebook, and spawned DDP ranks re-run it.
+from tqdm import tqdm as train_tqdm
 import torch
+import torch.distributed as dist
 
 
-def valid(dataloader, model, criterion, device): 
+def is_main_process():
+    """Only rank 0 logs and saves when training with DistributedDataParallel."""
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def valid(dataloader, model, device): 
     """Validate on validation set."""
 
     model.eval()
     running_loss = 0.0
     running_accuracy = 0.0
-    pbar = tqdm(total=len(dataloader.dataset), ncols=0, desc="Valid", unit=" uttr")
+    pbar = train_tqdm(total=len(dataloader.dataset), ncols=0, desc="Valid", unit=" uttr", disable=not is_main_process())
 
     for i, batch in enumerate(dataloader):
         with torch.no_grad():
-            loss, accuracy = model_fn(batch, model, criterion, device)
+            loss, accuracy = model_fn(batch, model, device)
             running_loss += loss.item()
             running_accuracy += accuracy.item()
 
@@ -402,10 +567,14 @@ def valid(dataloader, model, criterion, device):
 # In[18]:
 
 
-from tqdm import tqdm
+import os
+from contextlib import nullcontext
+from tqdm import tqdm as train_tqdm
 
 import torch
-import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.optim import AdamW
 from torch.utils.data import DataLoader, random_split
 
@@ -416,11 +585,13 @@ def parse_args():
     "data_dir": "./Dataset",
     "save_path": "model4.ckpt",
     "batch_size": 256,
-    "n_workers": 0,
+    "n_workers": 8,
     "valid_steps": 2000,
     "warmup_steps": 1000,
     "save_steps": 10000,
     "total_steps": 200000,
+    "log_steps": 50,
+    "accum_steps": 4,
     
     }
 
@@ -436,65 +607,99 @@ def main(
     warmup_steps,
     total_steps,
     save_steps,
+    log_steps,
+    accum_steps,
+    rank=0,
+    world_size=1,
 ):
     """Main function."""
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    distributed = world_size > 1
+    if distributed:
+        os.environ.setdefault("MASTER_ADDR", "localhost")
+        os.environ.setdefault("MASTER_PORT", "29500")
+        dist.init_process_group("nccl", rank=rank, world_size=world_size)
+        torch.cuda.set_device(rank)
+        device = torch.device("cuda", rank)
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"[Info]: Use {device} now!")
+    # Training batches are almost always (batch_size, segment_len, 40), so cuDNN benchmarks the conv once and reuses the winner.
+    torch.backends.cudnn.benchmark = not torch.backends.cudnn.deterministic
 
-    train_loader, valid_loader, speaker_num = get_dataloader(data_dir, batch_size, n_workers)
-    train_iterator = iter(train_loader)
+    train_loader, valid_loader, speaker_num = get_dataloader(data_dir, batch_size, n_workers, rank, world_size)
     print(f"[Info]: Finish loading data!",flush = True)
 
     model = Classifier(n_spks=speaker_num).to(device)
+    if distributed:
+        model = DDP(model, device_ids=[rank])
+    # Input shape is fixed to (batch_size, segment_len, 40), so compile once and reuse.
+    model = torch.compile(model, mode="max-autotune", fullgraph=False)
 #     print(model)
-    criterion = nn.CrossEntropyLoss()
-    optimizer = AdamW(model.parameters(), lr=1e-3)
-    scheduler = get_cosine_schedule_with_warmup(optimizer, warmup_steps, total_steps)
+    # Scale the learning rate linearly with the data-parallel factor only;
+    # the accum_steps factor of the global batch is deliberately left unscaled.
+    lr = 1e-3 * world_size
+    # The fused kernel needs CUDA parameters; elsewhere use the multi-tensor (foreach) path.
+    if device.type == "cuda":
+        optimizer = AdamW(model.parameters(), lr=lr, fused=True)
+    else:
+        optimizer = AdamW(model.parameters(), lr=lr, foreach=True)
+    # The scheduler only advances on optimizer updates, i.e. once every accum_steps steps.
+    scheduler = get_cosine_schedule_with_warmup(
+        optimizer, warmup_steps // accum_steps, total_steps // accum_steps
+    )
     print(f"[Info]: Finish creating model!",flush = True)
 
     best_accuracy = -1.0
     best_state_dict = None
 
-    pbar = tqdm(total=valid_steps, ncols=0, desc="Train", unit=" step")
+    pbar = train_tqdm(total=valid_steps, ncols=0, desc="Train", unit=" step", disable=not is_main_process())
+    # Keep per-step stats on the device and only sync every log_steps steps.
+    loss_buf = []
+    acc_buf = []
 
-    for step in range(total_steps):
-    # Get data
-        try:
-            batch = next(train_iterator)
-        except StopIteration:
-            train_iterator = iter(train_loader)
-            batch = next(train_iterator)
+    # train_loader is infinite, so total_steps alone bounds the loop.
+    for step, batch in zip(range(total_steps), prefetch_to_device(train_loader, device)):
+        # Only all-reduce gradients on the batch that triggers an optimizer update.
+        update = (step + 1) % accum_steps == 0
+        with model.no_sync() if distributed and not update else nullcontext():
+            loss, accuracy = model_fn(batch, model, device)
+            loss_buf.append(loss.detach())
+            acc_buf.append(accuracy.detach())
 
-        loss, accuracy = model_fn(batch, model, criterion, device)
-        batch_loss = loss.item()
-        batch_accuracy = accuracy.item()
+            # Accumulate gradients over accum_steps batches before each update.
+            (loss / accum_steps).backward()
 
         # Updata model
-        loss.backward()
-        optimizer.step()
-        scheduler.step()
-        optimizer.zero_grad()
+        if update:
+            optimizer.step()
+            scheduler.step()
+            optimizer.zero_grad(set_to_none=True)
 
         # Log
         pbar.update()
-        pbar.set_postfix(
-            loss=f"{batch_loss:.2f}",
-            accuracy=f"{batch_accuracy:.2f}",
-            step=step + 1,
-        )
+        if (step + 1) % log_steps == 0:
+            batch_loss = torch.stack(loss_buf).mean().item()
+            batch_accuracy = torch.stack(acc_buf).mean().item()
+            loss_buf.clear()
+            acc_buf.clear()
+            pbar.set_postfix(
+                loss=f"{batch_loss:.2f}",
+                accuracy=f"{batch_accuracy:.2f}",
+                step=step + 1,
+            )
 
         # Do validation
         if (step + 1) % valid_steps == 0:
             pbar.close()
 
-            valid_accuracy = valid(valid_loader, model, criterion, device)
+            valid_accuracy = valid(valid_loader, model, device)
 
             # keep the best model
-            if valid_accuracy > best_accuracy:
+            if valid_accuracy > best_accuracy and is_main_process():
                 best_accuracy = valid_accuracy
                 best_state_dict = torch.save(model,model4)
 
-            pbar = tqdm(total=valid_steps, ncols=0, desc="Train", unit=" step")
+            pbar = train_tqdm(total=valid_steps, ncols=0, desc="Train", unit=" step", disable=not is_main_process())
 
         # Save the best model so far.
         if (step + 1) % save_steps == 0 and best_state_dict is not None:
@@ -502,10 +707,25 @@ def main(
             pbar.write(f"Step {step + 1}, best model saved. (accuracy={best_accuracy:.4f})")
 
     pbar.close()
+    if distributed:
+        dist.destroy_process_group()
+
 
+# Bind the training main as a default argument; the inference cell below redefines `main`.
+def run_distributed(rank, world_size, config, train_main=main):
+    """Entry point of every process spawned for DistributedDataParallel."""
+    train_main(**config, rank=rank, world_size=world_size)
 
-# if __name__ == "__main__":
-main(**parse_args())
+
+if __name__ == "__main__":
+    world_size = torch.cuda.device_count()
+    if world_size > 1:
+        config = parse_args()
+        # Build the feature and metadata caches once here so spawned ranks never write them concurrently.
+        myDataset(config["data_dir"])
+        mp.spawn(run_distributed, args=(world_size, config), nprocs=world_size)
+    else:
+        main(**parse_args())
 
 
 # # Inference
@@ -539,6 +759,22 @@ class InferenceDataset(Dataset):
 
         return feat_path, mel
 
+    def length_bucketed_batches(self, batch_size):
+        """Group indices into batches of equal mel_len, at most batch_size each."""
+        # The classifier has no padding mask, so only utterances of the same length may share a batch.
+        order = sorted(range(len(self.data)), key=lambda i: self.data[i]["mel_len"])
+        batches = []
+        for index in order:
+            if (
+                batches
+                and len(batches[-1]) < batch_size
+                and self.data[batches[-1][0]]["mel_len"] == self.data[index]["mel_len"]
+            ):
+                batches[-1].append(index)
+            else:
+                batches.append([index])
+        return batches
+
     
 
 def inference_collate_batch(batch):
@@ -618,6 +854,8 @@ def main(
     """Main function."""
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"[Info]: Use {device} now!")
+    # Test batches take one shape per distinct mel_len, so benchmarking would re-run for almost every batch.
+    torch.backends.cudnn.benchmark = False
 
     mapping_path = Path(data_dir) / "mapping.json"
     mapping = json.load(mapping_path.open())
@@ -625,37 +863,43 @@ def main(
     dataset = InferenceDataset(data_dir)
     dataloader = DataLoader(
         dataset,
-        batch_size=1,
-        shuffle=False,
-        drop_last=False,
+        batch_sampler=dataset.length_bucketed_batches(32),
         num_workers=0,
         collate_fn=inference_collate_batch,
     )
     print(f"[Info]: Finish loading data!",flush = True)
 
     speaker_num = len(mapping["id2speaker"])
+    # Run the ensemble in bf16 on the GPU to match training; the CPU fallback stays in fp32.
+    dtype = torch.bfloat16 if device.type == "cuda" else torch.float32
     model1 = Classifier(model_config["config1"], n_spks=speaker_num).to(device)
     model1.load_state_dict(torch.load(model_path['model1']))
-    model1.eval()
+    model1.eval().to(dtype)
+    # Test utterances keep their full lengths, so compile one shape-generic graph instead of one per length.
+    model1 = torch.compile(model1, dynamic=True)
     model2 = Classifier(model_config["config2"], n_spks=speaker_num).to(device)
     model2.load_state_dict(torch.load(model_path['model2']))
-    model2.eval()
+    model2.eval().to(dtype)
+    model2 = torch.compile(model2, dynamic=True)
     model3 = Classifier(model_config["config3"], n_spks=speaker_num).to(device)
     model3.load_state_dict(torch.load(model_path['model3']))
-    model3.eval()
+    model3.eval().to(dtype)
+    model3 = torch.compile(model3, dynamic=True)
     print(f"[Info]: Finish creating model!",flush = True)
 
     results = [["Id", "Category"]]
+    predictions = {}
     for feat_paths, mels in tqdm(dataloader):
-        with torch.no_grad():
-            mels = mels.to(device)
-            outs1 = model1(mels)
-            outs2 = model2(mels)
-            outs3 = model3(mels)
-            outs = (outs1+outs2+outs3) / 3
+        with torch.inference_mode():
+            mels = mels.to(device, dtype=dtype)
+            outs = (model1(mels) + model2(mels) + model3(mels)) / 3
             preds = outs.argmax(1).cpu().numpy()
             for feat_path, pred in zip(feat_paths, preds):
-                results.append([feat_path, mapping["id2speaker"][str(pred)]])
+                predictions[feat_path] = mapping["id2speaker"][str(pred)]
+
+    # Batches come in length order; write the rows back in the order of testdata.json.
+    for utterance in dataset.data:
+        results.append([utterance["feature_path"], predictions[utterance["feature_path"]]])
 
 
     with open(output_path, 'w', newline='') as csvfile:
@@ -663,8 +907,8 @@ def main(
         writer.writerows(results)
 
 
-    # if __name__ == "__main__":
-main(**parse_args())
+if __name__ == "__main__":
+    main(**parse_args())
 
 
 # In[ ]: